@@ -58,38 +58,198 @@ Version History
 """
 
 # Import python modules
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
 import os
 import re
+import string
+
+
+# Define constants
+# Filetypes that may be followed by a space and locations that may be preceded by a space in
+# YSFlight file paths.
+FILETYPES = ("srf", "dnm", "acp", "dat", "fld", "stp", "yfs")
+LOCATIONS = ("user", "aircraft", "ground", "scenery")
+
+# Matches an underscore directly after a filetype, which should be a space.
+FILETYPE_UNDERSCORE = re.compile("({})_".format("|".join(FILETYPES)))
+
+# Translation table to lowercase an ASCII path and swap \ for / in a single pass.
+PATH_TABLE = str.maketrans(string.ascii_uppercase + "\\", string.ascii_lowercase + "/")
+
+# Buffer size in bytes used when reading and writing YSFlight files. Larger than the usual
+# filesystem block size so big DNM files need fewer read and write calls.
+BUFFER_SIZE = 131072
 
 
 # Define custom functions
-def rename_all_files_or_folders(root, items):
-    """Loops through all the filenames or folders in a directory and renames them to lowercase.
-    
+def walk_scandir(path):
+    """Walk a directory tree bottom-up, similar to os.walk(path, topdown=False).
+
+    Uses os.scandir so the file/folder type information returned with the directory listing is
+    reused rather than making a separate stat call for every entry.
+
     inputs:
-    root (str): os.path like folder to operate in
-    items (list): list of string file or foldernames in the root directory.
+    path (str): os.path like folder to start the walk in.
+
+    yields:
+    (root, dirs, files) tuples where dirs and files are lists of os.DirEntry objects.
     """
-    for name in items:
-        try:
-            # Store the original file name
-            original_path = os.path.join(root, name)        
+    dirs = list()
+    files = list()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+    except OSError:
+        # Match os.walk and skip folders that cannot be listed.
+        return
 
-            # Make new path with a lower case name
-            new_path = os.path.join(root, name.lower())
+    for entry in dirs:
+        # Do not follow symlinked folders, same as os.walk.
+        if not entry.is_symlink():
+            for result in walk_scandir(entry.path):
+                yield result
 
-            # Replace space with underscore
-            new_path_string = str(new_path)
-            new_path_string.replace(" ", "_")
-            new_path = os.path.normpath(new_path_string)
-            
-            # Perform the file rename
-            os.rename(original_path, new_path)
+    yield path, dirs, files
+
+
+def rename_entries(entries, existing_names):
+    """Loops through all the files or folders in a directory and renames them to lowercase.
+
+    Spaces in the names are replaced with underscores.
+    
+    inputs:
+    entries (list): list of os.DirEntry files or folders from the same directory.
+    existing_names (collections.Counter): count of the lowercase names of every file and folder
+                                          in the directory. Updated as entries are renamed.
+
+    returns:
+    new_names (list): list of the file or foldernames after renaming. Entries that could not be
+                      renamed keep their original name.
+    """
+    new_names = list()
+    for entry in entries:
+        # Make a lower case name and replace spaces with underscores
+        name = entry.name
+        new_name = name.lower().replace(" ", "_")
+        if new_name == name:
+            # Already converted, nothing to rename
+            new_names.append(name)
+            continue
+
+        # Compare lowercase names because Windows and MacOS filesystems are case-insensitive.
+        # Don't count the entry's own name, as a case-only rename of itself is fine.
+        old_lower_name = name.lower()
+        other_names = existing_names[new_name] - (1 if old_lower_name == new_name else 0)
+        if other_names > 0:
+            # os.replace would silently overwrite the other file or folder.
+            print("ERROR")
+            print("Cannot rename {} to {}".format(name, new_name))
+            print("A file or folder with that name already exists.")
+            new_names.append(name)
+            continue
+
+        try:
+            # Perform the file rename. entry.path is the folder path followed by the name.
+            os.replace(entry.path, entry.path[:-len(name)] + new_name)
+            existing_names[old_lower_name] -= 1
+            existing_names[new_name] += 1
+            new_names.append(new_name)
             
         except OSError:
             print("ERROR")
             print("Cannot rename {}".format(name))
             print("Check permissions and try again.")
+            new_names.append(name)
+
+    return new_names
+
+
+def convert_instpanl_line(line):
+    """convert the path in a .dat file INSTPANL line to lower case.
+
+    inputs:
+    line (str): line from a dat file that starts with INSTPANL
+
+    returns:
+    line (str): the converted line, or the input line if it has no instrument panel path.
+    """
+    if line.startswith("INSTPANL") and ".ist" in line:
+        # Found an externally defined instrument panel file path.
+        if "#" in line:
+            line = line.split('#')[0]
+        path = line[9:] 
+        path = convert_string_path(path)
+        line = " ".join([line[:8], path])
+
+    return line
+
+
+def convert_wpnshape_line(line):
+    """convert the path in a .dat file WPNSHAPE line to lower case.
+
+    inputs:
+    line (str): line from a dat file that starts with WPNSHAPE
+
+    returns:
+    line (str): the converted line, or the input line if it has no weapon mesh path.
+    """
+    if line.startswith("WPNSHAPE") and (".srf" in line.lower() or ".dnm" in line.lower()):
+        # Found an externally defined weapon mesh.
+        if "FLYING" in line:
+            parts = line.split("FLYING")
+        else:
+            parts = line.split("STATIC")
+
+        path = parts[-1][1:]  # Should be a space at beginning of string
+        path = convert_string_path(path)
+        parts[-1] = " " + path  # Add space back to the path
+
+        if "FLYING" in line:
+            line = "FLYING".join(parts)
+        else:
+            line = "STATIC".join(parts)
+
+    return line
+
+
+def convert_carrier_line(line):
+    """convert the path in a .dat file CARRIER line to lower case.
+
+    inputs:
+    line (str): line from a dat file that starts with CARRIER
+
+    returns:
+    line (str): the converted line, or the input line if it has no acp path.
+    """
+    if line.startswith("CARRIER") and "." in line:
+        # version 1.4.2 update
+        path = line.split()[-1] 
+        path = convert_string_path(path)
+        line = " ".join([line[:8], path])
+
+    return line
+
+
+# Functions to convert the .dat file lines that can have paths, keyed by the first three
+# bytes of the line.
+DAT_LINE_HANDLERS = {
+    b"INS": convert_instpanl_line,
+    b"WPN": convert_wpnshape_line,
+    b"CAR": convert_carrier_line,
+}
 
 
 def process_dat_file(filepath):
@@ -105,56 +265,53 @@ def process_dat_file(filepath):
     filepath (str): os.path-like string to where a dat file is at
     """
     
-    raw_file = import_text_file(filepath)
+    # Rows are kept as bytes and only decoded when they might have a path in them.
+    raw_file = import_binary_file(filepath)
 
     if len(raw_file) > 0:
+        changed = False
         for row, line in enumerate(raw_file):
-            if line.startswith("INSTPANL") and ".ist" in line:
-                # Found an externally defined instrument panel file path.
-                if "#" in line:
-                    line = line.split('#')[0]
-                path = line[9:] 
-                path = convert_string_path(path)
-                raw_file[row] = " ".join([line[:8], path])
-                
-            elif line.startswith("WPNSHAPE") and (".srf" in line.lower() or ".dnm" in line.lower()):
-                # Found an externally defined weapon mesh.
-                if "FLYING" in line:
-                    parts = line.split("FLYING")
-                else:
-                    parts = line.split("STATIC")
-
-                path = parts[-1][1:]  # Should be a space at beginning of string
-                path = convert_string_path(path)
-                parts[-1] = " " + path  # Add space back to the path
-
-                if "FLYING" in line:
-                    raw_file[row] = "FLYING".join(parts)
-                else:
-                    raw_file[row] = "STATIC".join(parts)
-
-            elif line.startswith("CARRIER") and "." in line:
-                # version 1.4.2 update
-                path = line.split()[-1] 
-                path = convert_string_path(path)
-                raw_file[row] = " ".join([line[:8], path])
-
-        write_text_file(raw_file, filepath)
+            handler = DAT_LINE_HANDLERS.get(line[:3])
+            if handler is not None:
+                try:
+                    text_line = line.decode("utf8")
+                except UnicodeDecodeError:
+                    non_unicode_text_alert(filepath)
+                    return
+
+                new_line = handler(text_line)
+                if new_line != text_line:
+                    raw_file[row] = new_line.encode("utf8")
+                    changed = True
+
+        # Only re-write the file if a path was updated
+        if changed:
+            write_binary_file(raw_file, filepath)
     
 
+@functools.lru_cache(maxsize=4096)
 def convert_string_path(path):
     """convert a string from a YSFlight file into a lowercase path.
+
+    The result only depends on the input string, so results are cached. LST files in particular
+    repeat the same paths many times.
     
     inputs:
     path (str): os.path-like string from the YSFlight File
     """
     
-    filetypes = ["srf", "dnm", "acp", "dat", "fld", "stp", "yfs"]
-    locations = ["user", "aircraft", "ground", "scenery"]
-    
-    path = path.lower()
-    if "\\" in path:
-        path = path.replace("\\", "/") # This format is required for MacOS
+    # Most paths are already converted, so return them before doing any other work.
+    if path.islower() and "\\" not in path and " " not in path:
+        if "_" not in path or FILETYPE_UNDERSCORE.search(path) is None:
+            return path
+
+    if path.isascii():
+        path = path.translate(PATH_TABLE) # This format is required for MacOS
+    else:
+        # The table only covers ASCII letters, use str.lower for everything else.
+        path = path.lower()
+        if "\\" in path:
+            path = path.replace("\\", "/") # This format is required for MacOS
         
     if " " in path:
         # Version 1.4.1 update to better identify spaces that are allowed,
@@ -165,52 +322,29 @@ def convert_string_path(path):
         # Search for spaces that are allowed.
         # 1 - after a .filetype
         # 2 - before a location
-        space_idxs = [m.start() for m in re.finditer(" ", path)]
-        valid_spaces = list()
-        for idx in space_idxs:
-            # Evaluate each space individually
-            valid_space = False
-
-            # Test for valid condition 1, after a filetype.
-            if idx > 3:
-                for filetype in filetypes:
-                    if path[:idx].endswith(filetype):
-                        valid_space = True
-
-            # Test for valid condition 2, before a location
-            for location in locations:
-                if path[idx + 1:].startswith(location):
-                    valid_space = True
-                
-            valid_spaces.append(valid_space)
+        # Any other space is replaced with an underscore.
+        parts = path.split(" ")
+        new_path = [parts[0]]
+        idx = len(parts[0])  # Position of the space being evaluated
+        for before, after in zip(parts, parts[1:]):
+            if idx > 3 and before.endswith(FILETYPES):
+                new_path.append(" ")
+            elif after.startswith(LOCATIONS):
+                new_path.append(" ")
+            else:
+                new_path.append("_")
+            new_path.append(after)
+            idx += len(after) + 1
 
-        # Replace each invalid space with an underscore
-        for idx, validity in zip(space_idxs, valid_spaces):
-            if validity is False:
-                path = path[:idx] + "_" + path[idx + 1:]
+        path = "".join(new_path)
 
                     
     # Version 1.4.0 fix to look for issues with acceptable spaces
-    # being converted to underscores.
-    
-    for filetype in filetypes:
-        search = filetype + "_"
-        replace = filetype + " "
-        if search in path:
-            path = path.replace(search, replace)
-
-    # Version 1.4.0 fix to replace the v1.2.0 fix with common locations for addons.
-    for location in locations:
-        search = "_" + location
-        if search in path:
-            start_idxs = [m.start() for m in re.finditer(search, path)]
-            for idx in start_idxs:
-                for filetype in filetypes:
-                    new_search = filetype + search
-                    new_replace = "{} {}".format(filetype, location)
-                    if new_search in path:
-                        path = path.replace(new_search, new_replace)
-            
+    # being converted to underscores. This also covers the v1.2.0 "_user/"
+    # fix, since any location following a filetype is handled the same way.
+    if "_" in path:
+        path = FILETYPE_UNDERSCORE.sub(r"\1 ", path)
+
     return path
         
 
@@ -224,13 +358,15 @@ def process_dnm_file(filepath):
     inputs:
     filepath (str): os.path-like to where a dnm file is.
     """
-    raw_file = import_text_file(filepath)
+    # Rows are kept as bytes and only decoded when they might have a path in them.
+    raw_file = import_binary_file(filepath)
     
     if len(raw_file) > 0:
-        # Identify internally defined elements.
+        # Identify internally defined elements and process the SRF FIL lines.
         pck_names = list()
-        for line in raw_file:
-            if line.startswith("PCK"):
+        changed = False
+        for row, line in enumerate(raw_file):
+            if line.startswith(b"PCK"):
                 # Unknown if spaces can exist in the PCK name, so we will make the name
                 # extraction so it doesn't matter. We know that the length of the 
                 parts = line.split()
@@ -242,15 +378,23 @@ def process_dnm_file(filepath):
                 
                 pck_names.append(name)
 
-        # Process the SRF FIL lines.
-        for row, line in enumerate(raw_file):
-            if line.startswith("FIL"):
-                path = line[4:]
+            elif line.startswith(b"FIL"):
+                try:
+                    path = line[4:].decode("utf8")
+                except UnicodeDecodeError:
+                    non_unicode_text_alert(filepath)
+                    return
+
                 path = convert_string_path(path)
 
-                raw_file[row] = "FIL " + path
+                new_line = b"FIL " + path.encode("utf8")
+                if new_line != line:
+                    raw_file[row] = new_line
+                    changed = True
 
-        write_text_file(raw_file, filepath)
+        # Only re-write the file if a path was updated
+        if changed:
+            write_binary_file(raw_file, filepath)
     
 
 def process_lst_file(filepath):
@@ -269,19 +413,19 @@ def process_lst_file(filepath):
         # Scenery LST files need to be handled differently because we should
         # expect the first entry in each line to NOT be a path.
         lst_file_name = os.path.basename(filepath)
-        if lst_file_name.startswith("sce"):
-            is_scenery = True
-        else:
-            is_scenery = False
-
-        # Convert each line of text to lower case
-        for row, line in enumerate(raw_file):
-            raw_file[row] = convert_string_path(line)
+        is_scenery = lst_file_name.startswith("sce")
 
-        # Check the filepaths in the lst line for completness
+        changed = False
         for row, line in enumerate(raw_file):
-            if len(line) > 20:  # Don't process empty lines
-                parts = line.split(" ")
+            # Convert the line of text to lower case
+            new_line = convert_string_path(line)
+            if new_line != line:
+                raw_file[row] = new_line
+                changed = True
+
+            # Check the filepaths in the lst line for completness
+            if len(new_line) > 20:  # Don't process empty lines
+                parts = new_line.split(" ")
                 for element, path in enumerate(parts):
                     if len(path) > 2:
                         # Path must be greater than 2 in order to account for
@@ -290,7 +434,7 @@ def process_lst_file(filepath):
                         
                         # Some paths may be multiple spaces at trailing end of
                         # the lst file line. Ignore paths with zero length.
-                        if is_scenery == True and element == 0:
+                        if is_scenery and element == 0:
                             # Ignore this line from the analysis
                             continue
                         elif "." not in path[-6:]:
@@ -300,7 +444,9 @@ def process_lst_file(filepath):
                             print("  Found in line {}".format(row + 1))
                             print("  {}".format(path))
 
-        write_text_file(raw_file, filepath)
+        # Only re-write the file if a path was updated
+        if changed:
+            write_text_file(raw_file, filepath)
 
 
 def process_fld(filepath):
@@ -324,6 +470,7 @@ def process_fld(filepath):
 
     # Find all FIL lines that reference an external file, i.e. not
     # in the PCK list.
+    changed = False
     for idx, line in enumerate(raw_file):
         if line.startswith("FIL") and "." in line:
             temp_line = line.lower()
@@ -336,9 +483,14 @@ def process_fld(filepath):
 
                 if path not in pck_names:
                     path = convert_string_path(path)
-                    raw_file[idx] = 'FIL "{}"'.format(path)
+                    new_line = 'FIL "{}"'.format(path)
+                    if new_line != line:
+                        raw_file[idx] = new_line
+                        changed = True
 
-    write_text_file(raw_file, filepath)
+    # Only re-write the file if a path was updated
+    if changed:
+        write_text_file(raw_file, filepath)
 
 
 def process_acp(filepath):
@@ -349,10 +501,16 @@ def process_acp(filepath):
     """
     raw_file = import_text_file(filepath)
 
+    changed = False
     for i in range(0,4):
-        raw_file[i] = convert_string_path(raw_file[i])
+        new_line = convert_string_path(raw_file[i])
+        if new_line != raw_file[i]:
+            raw_file[i] = new_line
+            changed = True
 
-    write_text_file(raw_file, filepath)
+    # Only re-write the file if a path was updated
+    if changed:
+        write_text_file(raw_file, filepath)
     
 
 def import_text_file(filepath):
@@ -363,18 +521,37 @@ def import_text_file(filepath):
     """
     data = list()
     try:
-        with open(filepath, "r", encoding="utf8") as txt_file:
-            data = txt_file.readlines()
+        with open(filepath, "rb", buffering=BUFFER_SIZE) as txt_file:
+            text = txt_file.read().decode("utf8")
+
+        # Split into rows on \n, \r\n or \r like text mode does. str.splitlines would also
+        # split on other characters such as form feeds, so it is not used here.
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        data = text.split("\n")
+        if data[-1] == "":
+            # File ends with a newline or is empty
+            data.pop()
     except UnicodeDecodeError:
         non_unicode_text_alert(filepath)
 
-    # Strip \n from rows
-    for row, line in enumerate(data):
-        if line.endswith("\n"):
-            data[row] = line[:-1]
     return data        
 
 
+def import_binary_file(filepath):
+    """Import a file as a list of bytes but without the newline characters at the end. The rows
+    are not decoded so that only the rows that need processing have to be.
+    
+    inputs:
+    filepath (str): os.path-like to where a file to read in is located.
+    """
+    with open(filepath, "rb", buffering=BUFFER_SIZE) as bin_file:
+        # bytes.splitlines only splits on \n, \r\n or \r, the same as reading in text mode.
+        data = bin_file.read().splitlines()
+
+    return data
+
+
 def write_text_file(data, filepath):
     """write a modified YSFlight file to the specified location
     
@@ -383,12 +560,27 @@ def write_text_file(data, filepath):
     filepath (str): os.path-like to where the file should be written to.
     """
     
-    with open(filepath, 'w') as txt_file:
-        for line in data:
-            if "\n" not in line:
-                txt_file.write(line + "\n")
-            else:
-                txt_file.write(line)
+    if len(data) > 0:
+        with open(filepath, 'w', encoding="utf8", buffering=BUFFER_SIZE) as txt_file:
+            # Rows should not have a newline, but don't double up if one does.
+            txt_file.write("\n".join(line[:-1] if line.endswith("\n") else line for line in data))
+            txt_file.write("\n")
+
+
+def write_binary_file(data, filepath):
+    """write a modified YSFlight file that was imported with import_binary_file.
+    
+    inputs:
+    data (list): list of utf8 encoded bytes where each element is a complete row of the file.
+    filepath (str): os.path-like to where the file should be written to.
+    """
+    
+    if len(data) > 0:
+        # Use the platform newline, the same as write_text_file does in text mode.
+        newline = os.linesep.encode("utf8")
+        with open(filepath, 'wb', buffering=BUFFER_SIZE) as bin_file:
+            bin_file.write(newline.join(data))
+            bin_file.write(newline)
 
 
 def non_unicode_text_alert(filepath):
@@ -409,6 +601,44 @@ def non_unicode_text_alert(filepath):
     print("  Check for non-unicode text in this file and delete bad characters. Then re-run this code.")
 
 
+def process_job(job):
+    """Process a single YSFlight file. This is a module level function so that it can be sent to
+    the worker processes that run the jobs in parallel.
+
+    Anything the handler prints is captured and returned instead, because output from the worker
+    processes does not reach the IDLE shell and could interleave between files. An error while
+    processing the file is reported the same way so the other files' messages are not lost.
+
+    inputs:
+    job (tuple): os.path-like to the file and the function that processes that filetype.
+
+    returns:
+    messages (str): text printed while processing the file, to be printed by the main process.
+    """
+    filepath, handler = job
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        try:
+            handler(filepath)
+        except Exception as error:
+            rel_path = os.path.relpath(filepath, start=os.getcwd())
+            print("ERROR")
+            print("Unable to process {}".format(rel_path))
+            print("  {}: {}".format(type(error).__name__, error))
+
+    return messages.getvalue()
+
+
+# Functions to process each YSFlight filetype, keyed by the lowercase file extension.
+HANDLERS = {
+    ".dat": process_dat_file,
+    ".dnm": process_dnm_file,
+    ".lst": process_lst_file,
+    ".acp": process_acp,
+    ".fld": process_fld,
+}
+
+
 ####################################################################
 #                                                                  #
 #                       Script Begins Here                         #
@@ -416,29 +646,43 @@ def non_unicode_text_alert(filepath):
 ####################################################################
 
 
-print("Starting addon_to_linux version {}\n\n".format(__version__))
+if __name__ == "__main__":
+    print("Starting addon_to_linux version {}\n\n".format(__version__))
 
-# Initialize variables
-cwd = os.getcwd()  # This is the directory that will be worked on.
+    # Initialize variables
+    cwd = os.getcwd()  # This is the directory that will be worked on.
 
-# Rename all files to be lowercase and scrape out files that need to be handled
-for root, dirs, files in os.walk(cwd, topdown=False):
-    rename_all_files_or_folders(root, dirs)  # rename folders first
-    rename_all_files_or_folders(root, files)
+    # Rename all files to be lowercase and find the files that need to be processed. The walk is
+    # bottom-up so a folder's contents are finished before the folder itself is renamed. Files
+    # are stored relative to their folder so that the paths stay valid as parent folders are
+    # renamed.
+    folder_jobs = dict()
+    for root, dirs, files in walk_scandir(cwd):
+        existing_names = collections.Counter(entry.name.lower() for entry in dirs + files)
+        new_dir_names = rename_entries(dirs, existing_names)  # rename folders first
+        new_file_names = rename_entries(files, existing_names)
 
-# Find all files to process now that the paths are renamed
-for root, dirs, files in os.walk(cwd, topdown=False):
-    for file in files:
-        if file.endswith(".dat"):
-            process_dat_file(os.path.join(root, file))
-        elif file.endswith(".dnm"):
-            process_dnm_file(os.path.join(root, file))
-        elif file.endswith(".lst"):
-            process_lst_file(os.path.join(root, file))
-        elif file.endswith(".acp"):
-            process_acp(os.path.join(root, file))
-        elif file.endswith(".fld"):
-            process_fld(os.path.join(root, file))
+        root_jobs = list()
+        for entry, new_name in zip(dirs, new_dir_names):
+            for rel_path, handler in folder_jobs.pop(entry.path, []):
+                root_jobs.append((os.path.join(new_name, rel_path), handler))
 
-print("\n\nComplete.")
-            
+        for file in new_file_names:
+            handler = HANDLERS.get(os.path.splitext(file)[1].lower())
+            if handler is not None:
+                root_jobs.append((file, handler))
+
+        folder_jobs[root] = root_jobs
+
+    jobs = [(os.path.join(cwd, rel_path), handler) for rel_path, handler in folder_jobs.pop(cwd, [])]
+
+    # Each file is independent of the others, so process them in parallel now that every path
+    # has been renamed.
+    if len(jobs) > 0:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            # Print each file's messages here, in job order.
+            for messages in executor.map(process_job, jobs, chunksize=32):
+                if messages:
+                    print(messages, end="")
+
+    print("\n\nComplete.")